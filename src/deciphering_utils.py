@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import time
 from utils import *
 
 def compute_log_probability(text, permutation_map, char_to_ix, frequency_statistics, transition_matrix):
@@ -67,9 +68,13 @@ def compute_transition_counts(text, char_to_ix):
     
     return transition_counts
 
-def compute_log_probability_by_counts(transition_counts, text, permutation_map, char_to_ix, frequency_statistics, transition_matrix):
+def compute_log_probability_by_counts(transition_counts, text, permutation_map, char_to_ix, frequency_statistics, transition_matrix,
+                                      log_transition_matrix=None):
     """
     Computes the log probability of a text under a given permutation map.
+    
+    log_transition_matrix: precomputed log(transition_matrix + eps), saves taking the log
+                           on every call when given
     """
 
     eps = 1e-8  
@@ -86,7 +91,9 @@ def compute_log_probability_by_counts(transition_counts, text, permutation_map,
     except KeyError:
         return -np.inf  
 
-    log_tm = np.log(transition_matrix + eps)
+    log_tm = log_transition_matrix
+    if log_tm is None:
+        log_tm = np.log(transition_matrix + eps)
     log_tm_sub = log_tm[indices, :][:, indices]
 
     p += np.sum(transition_counts * log_tm_sub)
@@ -114,7 +121,52 @@ def compute_difference(text_1, text_2):
             
     return cnt
 
-def get_state(text, transition_matrix, frequency_statistics, char_to_ix):
+def load_model(filename, lexicon=False):
+    """
+    Computes the character statistics of a training corpus once, so that they can be
+    kept in memory and reused for many decodes
+    
+    Arguments:
+    filename: path to the training corpus
+    
+    lexicon: if True, the word lexicon of the corpus is built and kept with the model
+    
+    Returns:
+    model: see build_model
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        data = f.read()
+    
+    return build_model(data, filename, data if lexicon else None)
+
+def build_model(text, name, lexicon_text=None):
+    """
+    Builds a model from a training text
+    
+    Arguments:
+    text: training text for the character statistics
+    
+    name: name of the model
+    
+    lexicon_text: training text for the word lexicon, None for no lexicon. It must keep
+                  its line breaks, see compute_word_statistics_from_text.
+    
+    Returns:
+    model: dict with the outputs of compute_statistics and the log of the transition
+           matrix, and of compute_word_statistics if lexicon_text is given
+    """
+    char_to_ix, ix_to_char, tr, fr = compute_statistics_from_text(text)
+    model = {"name" : name, "char_to_ix" : char_to_ix, "ix_to_char" : ix_to_char,
+             "transition_matrix" : tr, "frequency_statistics" : fr,
+             "log_transition_matrix" : np.log(tr + 1e-8)}
+    if lexicon_text is not None:
+        wl, oov = compute_word_statistics_from_text(lexicon_text)
+        model["word_log_probability"] = wl
+        model["oov_log_probability"] = oov
+    
+    return model
+
+def get_state(text, transition_matrix, frequency_statistics, char_to_ix, log_transition_matrix=None):
     """
     Generates a default state of given text statistics
     
@@ -133,6 +185,8 @@ def get_state(text, transition_matrix, frequency_statistics, char_to_ix):
     state = {"text" : text, "transition_matrix" : transition_matrix, 
              "frequency_statistics" : frequency_statistics, "char_to_ix" : char_to_ix,
             "permutation_map" : p_map, "transition_counts" : transition_counts}
+    if log_transition_matrix is not None:
+        state["log_transition_matrix"] = log_transition_matrix
     
     return state
 
@@ -142,10 +196,238 @@ def compute_probability_of_state(state):
     """
     
     p = compute_log_probability_by_counts(state["transition_counts"], state["text"], state["permutation_map"], 
-                                          state["char_to_ix"], state["frequency_statistics"], state["transition_matrix"])
+                                          state["char_to_ix"], state["frequency_statistics"], state["transition_matrix"],
+                                          state.get("log_transition_matrix"))
+    
+    return p
+
+def compute_word_log_probability(text, permutation_map, word_log_probability, oov_log_probability):
+    """
+    Computes the word level log likelihood ratio of a text under a given permutation map,
+    against words that are all out of the lexicon. Each word of the lexicon adds
+    word_log_probability[w] - oov_log_probability, other words add nothing. A plain sum of
+    word log probabilities would favour maps that merge words together, as fewer words
+    give a higher sum.
+    
+    Arguments:
+    text: text, list of characters
+    
+    permutation_map[c]: gives the character to replace 'c' by
+    
+    word_log_probability: log probability of each word in the lexicon
+    
+    oov_log_probability: log probability of a word that is not in the lexicon
+    
+    Returns:
+    p: word level log likelihood ratio of the given text
+    """
+    decoded = ''.join(text).translate(str.maketrans(permutation_map))
+    p = 0.0
+    for w in WORD_RE.findall(decoded):
+        if w in word_log_probability:
+            p += word_log_probability[w] - oov_log_probability
     
     return p
 
+def get_refinement_state(state, word_log_probability, oov_log_probability, word_weight=1.0):
+    """
+    Extends a state with a word lexicon, for use with compute_refined_probability_of_state
+    """
+    new_state = dict(state)
+    new_state["word_log_probability"] = word_log_probability
+    new_state["oov_log_probability"] = oov_log_probability
+    new_state["word_weight"] = word_weight
+    return new_state
+
+def compute_refined_probability_of_state(state):
+    """
+    Computes the character level probability of a state plus the weighted word level
+    probability given by its lexicon
+    """
+    p = compute_probability_of_state(state)
+    p += state["word_weight"] * compute_word_log_probability(state["text"], state["permutation_map"],
+                                                             state["word_log_probability"],
+                                                             state["oov_log_probability"])
+    return p
+
+def _bigram_score_of_rows(transition_counts, log_tm, indices, rows):
+    """
+    Part of the bigram log probability coming from transitions into or out of the
+    given rows, with the permuted indices of compute_log_probability_by_counts
+    """
+    cols = indices[rows]
+    p = np.sum(transition_counts[rows, :] * log_tm[cols][:, indices])
+    p += np.sum(transition_counts[:, rows] * log_tm[indices][:, cols])
+    p -= np.sum(transition_counts[rows][:, rows] * log_tm[cols][:, cols])
+    return p
+
+def _cipher_words(text, permutation_map):
+    """
+    Counts the words of the decoded text by the cipher characters they are made of, and
+    lists the cipher words each character appears in
+    """
+    decoded = ''.join(text).translate(str.maketrans(permutation_map))
+    counts = {}
+    for m in WORD_RE.finditer(decoded):
+        w = ''.join(text[m.start():m.end()])
+        counts[w] = counts.get(w, 0) + 1
+    by_char = {}
+    for w in counts:
+        for c in set(w):
+            by_char.setdefault(c, []).append(w)
+    return counts, by_char
+
+def refine_state(state, max_passes=5, time_limit=None):
+    """
+    Greedy refinement of a state under compute_refined_probability_of_state. Every pass
+    tries swapping the mapping of each character seen in the text with the mapping of
+    every other character of the alphabet, and keeps the swaps that improve the score.
+    Characters not in the text are included, as they often hold the value a rare
+    character is missing, and groups are crossed, as propose_a_move crosses them too.
+    Both scores are updated from the swapped characters only, the character score from
+    their rows and columns of the transition counts, the word score from the words
+    holding them. Swaps that move a character in or out of the letters change the word
+    boundaries, and rescore all words.
+    
+    Arguments:
+    state: state from get_refinement_state
+    
+    max_passes: maximum number of passes over all pairs, stops earlier once a pass
+                makes no improvement
+    
+    time_limit: wall-clock budget in seconds, None for no limit
+    
+    Returns:
+    state: the refined state, state["refine_passes"] holds the number of passes completed
+    
+    p: its refined log probability
+    """
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+    p_map = dict(state["permutation_map"])
+    state = dict(state)
+    state["permutation_map"] = p_map
+    state["refine_passes"] = 0
+    text = state["text"]
+    wl = state["word_log_probability"]
+    oov = state["oov_log_probability"]
+    weight = state["word_weight"]
+    
+    in_text = set(text)
+    seen = [c for c in p_map if c in in_text]
+    seen_ix = {c: i for i, c in enumerate(seen)}
+    word_p = compute_word_log_probability(text, p_map, wl, oov)
+    
+    def word_score(w):
+        d = ''.join(p_map[c] for c in w)
+        return wl[d] - oov if d in wl else 0.0
+    
+    words, by_char = _cipher_words(text, p_map)
+    word_scores = {w: word_score(w) for w in words}
+    
+    # the character score is updated from the rows and columns of the swapped characters
+    cix = state["char_to_ix"]
+    counts = state["transition_counts"]
+    log_tm = state.get("log_transition_matrix")
+    if log_tm is None:
+        log_tm = np.log(state["transition_matrix"] + 1e-8)
+    indices = np.empty(len(cix), dtype=int)
+    for c, i in cix.items():
+        indices[i] = cix[p_map[c]]
+    char_p = compute_probability_of_state(state)
+    first = text[0] if text else None
+    log_fr = np.log(np.clip(state["frequency_statistics"], 1e-8, None))
+    p = char_p + weight * word_p
+    
+    for _ in range(max_passes):
+        improved = False
+        for i, c1 in enumerate(seen):
+            for c2 in p_map:
+                # swapping two characters that are both absent changes nothing,
+                # and pairs of seen characters are tried once
+                if c2 == c1 or seen_ix.get(c2, len(seen)) < i:
+                    continue
+                if deadline is not None and time.monotonic() >= deadline:
+                    return state, p
+                rows = np.array([cix[c1], cix[c2]])
+                char_p2 = char_p - _bigram_score_of_rows(counts, log_tm, indices, rows)
+                p_map[c1], p_map[c2] = p_map[c2], p_map[c1]
+                indices[rows] = indices[rows[::-1]]
+                char_p2 += _bigram_score_of_rows(counts, log_tm, indices, rows)
+                if first in (c1, c2):
+                    # the first character now decodes to what the other one decoded to
+                    other = c2 if first == c1 else c1
+                    char_p2 += log_fr[cix[p_map[first]]] - log_fr[cix[p_map[other]]]
+                if (p_map[c1] in LETTER_SET) == (p_map[c2] in LETTER_SET):
+                    # the words keep their boundaries, only those with c1 or c2 change
+                    new_scores = {w: word_score(w) for w in set(by_char.get(c1, []) + by_char.get(c2, []))}
+                    word_p2 = word_p + sum(words[w] * (q - word_scores[w]) for w, q in new_scores.items())
+                else:
+                    new_scores = None
+                    word_p2 = compute_word_log_probability(text, p_map, wl, oov)
+                p2 = char_p2 + weight * word_p2
+                if p2 > p:
+                    p = p2
+                    char_p = char_p2
+                    word_p = word_p2
+                    if new_scores is None:
+                        words, by_char = _cipher_words(text, p_map)
+                        word_scores = {w: word_score(w) for w in words}
+                    else:
+                        word_scores.update(new_scores)
+                    improved = True
+                else:
+                    p_map[c1], p_map[c2] = p_map[c2], p_map[c1]
+                    indices[rows] = indices[rows[::-1]]
+        state["refine_passes"] += 1
+        if not improved:
+            break
+    
+    return state, p
+
+def refine_candidates(ranked, word_log_probability, oov_log_probability, word_weight=1.0,
+                      top=3, max_passes=5, time_limit=None):
+    """
+    Second stage of decoding: refines the best distinct candidates of the character level
+    chains with the word lexicon, and ranks them by the refined score
+    
+    Arguments:
+    ranked: list of (state, log probability), best first
+    
+    word_log_probability, oov_log_probability: lexicon from compute_word_statistics
+    
+    word_weight: weight of the word level log likelihood
+    
+    top: number of distinct candidates to refine
+    
+    max_passes: passed on to refine_state
+    
+    time_limit: wall-clock budget in seconds for all candidates together, None for no limit
+    
+    Returns:
+    refined: list of (state, refined log probability), best first
+    """
+    start = time.monotonic()
+    candidates = []
+    keys = set()
+    for st, _ in ranked:
+        key = tuple(sorted(st["permutation_map"].items()))
+        if key not in keys:
+            keys.add(key)
+            candidates.append(st)
+        if len(candidates) == top:
+            break
+    
+    refined = []
+    for k, st in enumerate(candidates):
+        budget = None
+        if time_limit is not None:
+            budget = max(time_limit - (time.monotonic() - start), 0) / (len(candidates) - k)
+        st = get_refinement_state(st, word_log_probability, oov_log_probability, word_weight)
+        refined.append(refine_state(st, max_passes=max_passes, time_limit=budget))
+    
+    refined.sort(key=lambda x: x[1], reverse=True)
+    return refined
+
 import numpy as np
 
 LETTER_SET = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import sys
+import json
+import socket
+from optparse import OptionParser
+
+def send_request(request, socket_path=None, host="127.0.0.1", port=8765):
+    """
+    Sends one decode request to a running decode_server and returns its JSON response
+    """
+    if socket_path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    else:
+        sock = socket.create_connection((host, port))
+
+    with sock, sock.makefile("rwb") as f:
+        f.write((json.dumps(request) + "\n").encode("utf-8"))
+        f.flush()
+        line = f.readline()
+
+    if not line:
+        raise ConnectionError("server closed the connection without answering")
+    return json.loads(line)
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("-d", "--decode", dest="decode", default=None,
+                      help="file that needs to be decoded, stdin is read otherwise")
+    parser.add_option("-s", "--socket", dest="socket", default=None,
+                      help="unix socket path of the server")
+    parser.add_option("-H", "--host", dest="host", default="127.0.0.1",
+                      help="server host when no socket is given")
+    parser.add_option("-P", "--port", dest="port", default=8765, type="int",
+                      help="server port when no socket is given")
+    parser.add_option("--model", dest="model", default=None,
+                      help="training corpus the server should decode with, selected per message if not given")
+    parser.add_option("-e", "--iters", dest="iterations", default=None, type="int",
+                      help="number of iterations per restart")
+    parser.add_option("-n", "--restarts", dest="restarts", default=None, type="int",
+                      help="number of restarts")
+    parser.add_option("-t", "--tolerance", dest="tolerance", default=None, type="float",
+                      help="acceptance tolerance")
+    parser.add_option("-T", "--time_limit", dest="time_limit", default=None, type="float",
+                      help="time budget in seconds for the request")
+    parser.add_option("--mixture", dest="mixture", action="store_true", default=None,
+                      help="decode with a weighted mixture of the server models")
+    parser.add_option("--temperature", dest="temperature", default=None, type="float",
+                      help="temperature of the mixture weights, in nats per character")
+    parser.add_option("--no_refine", dest="refine", action="store_false", default=None,
+                      help="skip the word lexicon refinement")
+    parser.add_option("-j", "--json", dest="json", action="store_true", default=False,
+                      help="print the full JSON response")
+
+    (options, args) = parser.parse_args(argv)
+
+    if options.decode is None:
+        text = sys.stdin.read()
+    else:
+        with open(options.decode, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+    request = {"text" : text}
+    for key, value in (("model", options.model), ("iters", options.iterations),
+                       ("restarts", options.restarts), ("tolerance", options.tolerance),
+                       ("time_limit", options.time_limit), ("refine", options.refine),
+                       ("mixture", options.mixture), ("temperature", options.temperature)):
+        if value is not None:
+            request[key] = value
+
+    response = send_request(request, options.socket, options.host, options.port)
+
+    if options.json:
+        print(json.dumps(response, indent=2))
+    elif response["ok"]:
+        print(response["decoded"])
+    else:
+        print("Error: " + response["error"], file=sys.stderr)
+
+    if not response["ok"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
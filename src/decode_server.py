@@ -0,0 +1,356 @@
+#!/usr/bin/python
+
+import sys
+import os
+import json
+import math
+import time
+import socket
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from metropolis_hastings import *
+from deciphering_utils import *
+from model_selection import *
+from utils import az_list
+
+ALPHABET = az_list()
+
+_MODELS = {}
+
+# share of a request's time limit the chains may use when the decode is refined
+CHAIN_TIME_SHARE = 0.75
+
+def decode_message(raw_text_str, model, iters=5000, restarts=3, tolerance=0.02, time_limit=None,
+                   refine=True, word_weight=1.0):
+    """
+    Decodes a single message with a model that is already in memory
+
+    Arguments:
+    raw_text_str: ciphertext as a string, characters outside of the alphabet are kept as they are
+
+    model: model as returned by load_model
+
+    iters: number of iterations for each restart
+
+    restarts: number of metropolis hastings chains to run
+
+    tolerance: acceptance tolerance passed on to metropolis_hastings
+
+    time_limit: wall-clock budget in seconds for the whole decode, None for no limit. When
+                refining, a quarter of it is kept for the refinement.
+
+    refine: refine the best chain results with the word lexicon of the model, if it has one
+
+    word_weight: weight of the word level log likelihood during refinement
+
+    Returns:
+    result: dict with the decoded text, its character log probability, its refined log
+            probability if refined, and some run statistics
+    """
+    start = time.monotonic()
+    refine = refine and "word_log_probability" in model
+    chain_time = time_limit
+    if refine and time_limit is not None:
+        chain_time = CHAIN_TIME_SHARE * time_limit
+    raw_text_str = raw_text_str.replace("\r\n", "\n").replace("\r", "\n")
+    clean_text = [c for c in raw_text_str if c in ALPHABET]
+    if not clean_text:
+        return {"decoded" : raw_text_str, "log_probability" : None, "refined_log_probability" : None,
+                "iterations" : 0, "restarts" : 0, "refined" : False, "elapsed" : 0.0, "model" : model["name"]}
+
+    init_state = get_state(clean_text, model["transition_matrix"], model["frequency_statistics"],
+                           model["char_to_ix"], model["log_transition_matrix"])
+
+    candidates = [(init_state, compute_probability_of_state(init_state))]
+    iterations = 0
+    done = 0
+    for k in range(restarts):
+        budget = None
+        if chain_time is not None:
+            remaining = chain_time - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            budget = remaining / (restarts - k)
+
+        states, lps, _ = metropolis_hastings(
+            init_state,
+            proposal_function = propose_a_move,
+            log_density       = compute_probability_of_state,
+            iters             = iters,
+            tolerance         = tolerance,
+            time_limit        = budget,
+            verbose           = False
+        )
+        done += 1
+        iterations += len(lps)
+        # states[0] is the initial state, lps[i] belongs to states[i+1]
+        if lps:
+            i = int(np.argmax(lps))
+            candidates.append((states[i + 1], lps[i]))
+
+    candidates.sort(key=lambda x: x[1], reverse=True)
+    refined_lp = None
+    if refine:
+        budget = None if time_limit is None else max(time_limit - (time.monotonic() - start), 0)
+        candidates = refine_candidates(candidates, model["word_log_probability"],
+                                       model["oov_log_probability"], word_weight=word_weight,
+                                       time_limit=budget)
+        refined_lp = float(candidates[0][1])
+    best_state = candidates[0][0]
+    refined = best_state.get("refine_passes", 0) > 0
+
+    decoded = ''.join(scramble_text(raw_text_str, best_state["permutation_map"]))
+    return {"decoded" : decoded, "log_probability" : float(compute_probability_of_state(best_state)),
+            "refined_log_probability" : refined_lp,
+            "iterations" : iterations, "restarts" : done, "refined" : refined,
+            "elapsed" : time.monotonic() - start, "model" : model["name"]}
+
+def _init_worker(models):
+    """
+    Keeps the models in memory of each worker process
+    """
+    _MODELS.update(models)
+
+def socket_in_use(path):
+    """
+    Tells whether a server answers on the unix socket path
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def _run_job(job):
+    start = time.monotonic()
+    time_limit = job["time_limit"]
+    report = None
+    clean_text = [c for c in job["text"] if c in ALPHABET]
+    if job["model"] is None and not clean_text:
+        # nothing to select on, decode_message returns the text as it is
+        model = next(iter(_MODELS.values()))
+    elif job["model"] is None:
+        # selection gets at most a tenth of the request budget, shared by the pilot
+        # chains and the polish of their best state
+        pilot_time = 1.0
+        if time_limit is not None:
+            pilot_time = min(1.0, 0.1 * time_limit / (job["pilot_runs"] + 1))
+        model, report = select_model(_MODELS, clean_text, pilot_iters=job["pilot_iters"],
+                                     pilot_time=pilot_time, pilot_runs=job["pilot_runs"],
+                                     pilot_weight=job["pilot_weight"],
+                                     mixture=job["mixture"], temperature=job["temperature"])
+        if time_limit is not None:
+            time_limit = max(time_limit - (time.monotonic() - start), 0)
+    else:
+        model = _MODELS[job["model"]]
+
+    result = decode_message(job["text"], model, iters=job["iters"], restarts=job["restarts"],
+                            tolerance=job["tolerance"], time_limit=time_limit,
+                            refine=job["refine"], word_weight=job["word_weight"])
+    result["selection"] = report
+    result["elapsed"] = time.monotonic() - start
+    return result
+
+def resolve_model_name(name, models):
+    """
+    Looks up a model by its training file path or by the base name of that file
+    """
+    if name in models:
+        return name
+    for key in models:
+        if os.path.basename(key) == name:
+            return key
+    raise ValueError(f"unknown model {name!r}")
+
+def _get_number(request, key, default, integer=False, allow_zero=False):
+    """
+    Reads a finite, positive (or non-negative with allow_zero) number from a request
+    """
+    value = request.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{key} must be a number")
+    if not math.isfinite(value) or value < 0 or (value == 0 and not allow_zero):
+        raise ValueError(f"{key} must be finite and {'non-negative' if allow_zero else 'positive'}")
+    if integer:
+        if value != int(value):
+            raise ValueError(f"{key} must be an integer")
+        return int(value)
+    return float(value)
+
+def build_job(request, models, options):
+    """
+    Validates a decode request and fills in the server defaults.
+    Iterations and time are capped by the server limits. Without a model, or with
+    "mixture" set, the model is selected per message when several are loaded.
+    """
+    if not isinstance(request, dict) or not isinstance(request.get("text"), str):
+        raise ValueError("request must be a JSON object with a 'text' string")
+
+    refine = request.get("refine", True)
+    if not isinstance(refine, bool):
+        raise ValueError("refine must be true or false")
+
+    mixture = request.get("mixture", False)
+    if not isinstance(mixture, bool):
+        raise ValueError("mixture must be true or false")
+    model = request.get("model")
+    if model is not None and not mixture:
+        model = resolve_model_name(model, models)
+    elif len(models) == 1 and not mixture:
+        model = next(iter(models))
+    else:
+        model = None
+
+    iters = min(_get_number(request, "iters", options.iterations, integer=True), options.max_iters)
+    restarts = min(_get_number(request, "restarts", options.restarts, integer=True), options.max_restarts)
+    tolerance = _get_number(request, "tolerance", options.tolerance, allow_zero=True)
+    if tolerance > 1:
+        raise ValueError("tolerance must be at most 1")
+    time_limit = options.max_time
+    if request.get("time_limit") is not None:
+        time_limit = min(_get_number(request, "time_limit", None), options.max_time)
+
+    return {"text" : request["text"], "model" : model, "iters" : iters,
+            "restarts" : restarts, "tolerance" : tolerance, "time_limit" : time_limit,
+            "refine" : refine,
+            "word_weight" : _get_number(request, "word_weight", options.word_weight, allow_zero=True),
+            "mixture" : mixture,
+            "pilot_iters" : min(_get_number(request, "pilot_iters", options.pilot_iters, integer=True),
+                                options.max_iters),
+            "pilot_runs" : min(_get_number(request, "pilot_runs", options.pilot_runs, integer=True),
+                               options.max_restarts),
+            "pilot_weight" : _get_number(request, "pilot_weight", options.pilot_weight, allow_zero=True),
+            "temperature" : _get_number(request, "temperature", options.temperature)}
+
+async def _discard_line(reader):
+    """
+    Skips the rest of a line that is longer than the stream limit
+    """
+    while True:
+        try:
+            await reader.readuntil(b"\n")
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return
+
+async def handle_client(reader, writer, pool, models, options):
+    """
+    Serves newline delimited JSON requests, one JSON response line per request
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                line = e.partial
+            except asyncio.LimitOverrunError:
+                line = None
+                await _discard_line(reader)
+            if line is not None and not line:
+                break
+            if line is not None and not line.strip():
+                continue
+            try:
+                if line is None:
+                    raise ValueError(f"request larger than {options.max_request} bytes")
+                job = build_job(json.loads(line), models, options)
+                result = await loop.run_in_executor(pool, _run_job, job)
+                response = dict(ok=True, **result)
+            except Exception as e:
+                response = {"ok" : False, "error" : f"{type(e).__name__}: {e}"}
+            writer.write((json.dumps(response) + "\n").encode("utf-8"))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(models, options):
+    with ProcessPoolExecutor(max_workers=options.workers, initializer=_init_worker,
+                             initargs=(models,)) as pool:
+        handler = lambda r, w: handle_client(r, w, pool, models, options)
+        if options.socket:
+            if os.path.exists(options.socket):
+                os.unlink(options.socket)
+            server = await asyncio.start_unix_server(handler, path=options.socket, limit=options.max_request)
+            where = options.socket
+        else:
+            server = await asyncio.start_server(handler, host=options.host, port=options.port,
+                                                limit=options.max_request)
+            where = f"{options.host}:{options.port}"
+
+        # warm up every worker so the first requests don't pay for process startup
+        await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(pool, time.sleep, 0)
+                               for _ in range(options.workers)])
+        print(f"Serving {', '.join(models)} on {where}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="inputfiles", action="append",
+                      help="training corpus to keep in memory, can be given several times")
+    parser.add_option("-s", "--socket", dest="socket", default=None,
+                      help="unix socket path to listen on, localhost TCP is used otherwise")
+    parser.add_option("-H", "--host", dest="host", default="127.0.0.1",
+                      help="host to listen on when no socket is given")
+    parser.add_option("-P", "--port", dest="port", default=8765, type="int",
+                      help="port to listen on when no socket is given")
+    parser.add_option("-w", "--workers", dest="workers", default=os.cpu_count() or 1, type="int",
+                      help="number of worker processes")
+    parser.add_option("-e", "--iters", dest="iterations", default=5000, type="int",
+                      help="default number of iterations per restart")
+    parser.add_option("-n", "--restarts", dest="restarts", default=3, type="int",
+                      help="default number of restarts")
+    parser.add_option("-t", "--tolerance", dest="tolerance", default=0.02, type="float",
+                      help="default acceptance tolerance")
+    parser.add_option("-l", "--lexicon", dest="lexicon", action="store_true", default=False,
+                      help="keep a word lexicon of each corpus to refine the decodes with")
+    parser.add_option("--word_weight", dest="word_weight", default=1.0, type="float",
+                      help="default weight of the word lexicon score during refinement")
+    parser.add_option("--pilot_iters", dest="pilot_iters", default=500, type="int",
+                      help="iterations of the pilot chains when a model is selected per message")
+    parser.add_option("--pilot_runs", dest="pilot_runs", default=1, type="int",
+                      help="number of pilot chains when a model is selected per message")
+    parser.add_option("--pilot_weight", dest="pilot_weight", default=2.0, type="float",
+                      help="default weight of the pilot in the model score, 0 skips it")
+    parser.add_option("--temperature", dest="temperature", default=0.1, type="float",
+                      help="default temperature of the mixture weights, in nats per character")
+    parser.add_option("--max_iters", dest="max_iters", default=100000, type="int",
+                      help="upper bound on the iterations a request may ask for")
+    parser.add_option("--max_restarts", dest="max_restarts", default=10, type="int",
+                      help="upper bound on the restarts a request may ask for")
+    parser.add_option("--max_request", dest="max_request", default=16 * 1024 * 1024, type="int",
+                      help="upper bound in bytes on the size of one request line")
+    parser.add_option("-T", "--max_time", dest="max_time", default=60.0, type="float",
+                      help="upper bound in seconds on the time spent on one request")
+
+    (options, args) = parser.parse_args(argv)
+
+    if not options.inputfiles:
+        print("Input file is not specified. Type -h for help.")
+        sys.exit(2)
+
+    if options.socket and os.path.exists(options.socket) and socket_in_use(options.socket):
+        print(f"A server is already listening on {options.socket}.")
+        sys.exit(2)
+
+    models = build_registry(options.inputfiles, lexicon=options.lexicon)
+
+    try:
+        asyncio.run(serve(models, options))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if options.socket and os.path.exists(options.socket):
+            os.unlink(options.socket)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,6 +3,7 @@ from optparse import OptionParser
 from pathlib import Path
 from metropolis_hastings import *
 from deciphering_utils    import *
+from model_selection      import *
 from utils                import az_list
 
 ALPHABET   = az_list()
@@ -59,23 +60,39 @@ def robust_read(path):
 
 def main(argv):
     parser = OptionParser()
-    parser.add_option("-i","--input", dest="inputfile", help="training corpus")
+    parser.add_option("-i","--input", dest="inputfile", action="append",
+                      help="training corpus, given several times the best fitting one is selected")
     parser.add_option("-d","--decode",dest="decode", help="ciphertext file")
     parser.add_option("-r","--reference",dest="ref", help="plaintext reference")
     parser.add_option("-e","--iters",dest="iterations", default=5000,  type="int")
     parser.add_option("-p","--print_every",dest="print_every", default=10000,type="int")
     parser.add_option("-n","--restarts",dest="restarts", default=3,     type="int")
     parser.add_option("-t","--tolerance",dest="tolerance",default=0.02, type="float")
+    parser.add_option("-l","--lexicon",dest="lexicon", action="store_true", default=False,
+                      help="refine the best guesses with a word lexicon of the training corpus")
+    parser.add_option("--word_weight",dest="word_weight",default=1.0, type="float")
+    parser.add_option("--refine_passes",dest="refine_passes",default=5, type="int")
+    parser.add_option("--refine_time",dest="refine_time",default=10.0, type="float",
+                      help="time budget in seconds of the refinement, 0 for no limit")
+    parser.add_option("-m","--mixture",dest="mixture", action="store_true", default=False,
+                      help="decode with a weighted mixture of the training corpora")
+    parser.add_option("--pilot_iters",dest="pilot_iters",default=500, type="int")
+    parser.add_option("--pilot_runs",dest="pilot_runs",default=1, type="int")
+    parser.add_option("--pilot_weight",dest="pilot_weight",default=2.0, type="float")
+    parser.add_option("--temperature",dest="temperature",default=0.1, type="float",
+                      help="temperature of the mixture weights, in nats per character")
     opts,_ = parser.parse_args(argv)
 
     if not opts.inputfile or not opts.decode:
         parser.error("-i INPUT and -d DECODE are required")
 
 
-    train_raw   = robust_read(opts.inputfile)
-    train_clean = ''.join(c for c in train_raw if c in ALPHABET)
-    Path("._clean_train.txt").write_text(train_clean, encoding="utf-8")
-    char_to_ix, ix_to_char, tr, fr = compute_statistics("._clean_train.txt")
+    registry = {}
+    for inputfile in opts.inputfile:
+        train_raw   = robust_read(inputfile)
+        train_clean = ''.join(c for c in train_raw if c in ALPHABET)
+        # the cleaned text lost its line breaks, words are taken from the raw text
+        registry[inputfile] = build_model(train_clean, inputfile, train_raw if opts.lexicon else None)
 
     raw_text_str = robust_read(opts.decode).replace("\r\n","\n").replace("\r","\n")
     raw_text   = list(raw_text_str)
@@ -85,7 +102,15 @@ def main(argv):
     reference     = list(reference_raw)[:len(raw_text)] if reference_raw else None
     gt_map        = build_gt_map(clean_text, [c for c in reference if c in ALPHABET]) if reference else {}
 
-    init_state = get_state(clean_text, tr, fr, char_to_ix)
+    model, report = select_model(registry, clean_text, pilot_iters=opts.pilot_iters,
+                                 pilot_runs=opts.pilot_runs,
+                                 pilot_weight=opts.pilot_weight, mixture=opts.mixture,
+                                 temperature=opts.temperature)
+    if len(registry) > 1 or opts.mixture:
+        print_selection(report)
+
+    init_state = get_state(clean_text, model["transition_matrix"], model["frequency_statistics"],
+                           model["char_to_ix"], model["log_transition_matrix"])
 
     states, lps = [], []
     for k in range(opts.restarts):
@@ -103,12 +128,20 @@ def main(argv):
 
     ranked = sorted(zip(states,lps), key=lambda x:x[1], reverse=True)
 
+    if opts.lexicon:
+        ranked = refine_candidates(ranked, model["word_log_probability"], model["oov_log_probability"],
+                                   word_weight=opts.word_weight,
+                                   max_passes=opts.refine_passes,
+                                   time_limit=opts.refine_time or None)
+
     print("\nBest Guesses:\n")
     for j,(st,lp) in enumerate(ranked[:3], 1):
         pmap    = st["permutation_map"]
         decoded = apply_map(raw_text, pmap)
 
-        metrics = [f"logP {lp:.0f}"]
+        metrics = [f"logP {compute_probability_of_state(st):.0f}"]
+        if opts.lexicon:
+            metrics.append(f"refined logP {lp:.0f}")
         if reference:
             (ov,ov_tot,ov_rt),(lt,lt_tot,lt_rt),(ot,ot_tot,ot_rt) = \
                 mapping_accuracy_grouped(pmap, gt_map)
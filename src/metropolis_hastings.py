@@ -3,7 +3,7 @@ import time
 import shutil
 import random
 
-def metropolis_hastings(initial_state, proposal_function, log_density, iters=1000, print_every=10, tolerance=0.02, error_function=None, pretty_state=None):
+def metropolis_hastings(initial_state, proposal_function, log_density, iters=1000, print_every=10, tolerance=0.02, error_function=None, pretty_state=None, time_limit=None, verbose=True):
     """
     Runs a metropolis hastings algorithm given the settings
     
@@ -28,6 +28,11 @@ def metropolis_hastings(initial_state, proposal_function, log_density, iters=100
     
     pretty_state: A function from your side to print the current state in a pretty format.
     
+    time_limit: wall-clock budget in seconds, the simulation stops once it is spent.
+                None means no limit.
+    
+    verbose: if False, diagnostics are neither printed nor paused for.
+    
     Returns:
     
     states: List of states generated during simulation
@@ -50,7 +55,10 @@ def metropolis_hastings(initial_state, proposal_function, log_density, iters=100
     it = 0
     prints = 0
     entropy_print = 100000
+    deadline = None if time_limit is None else time.monotonic() + time_limit
     while it < iters:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
 
         #propose a move
         new_state = proposal_function(state)
@@ -85,16 +93,17 @@ def metropolis_hastings(initial_state, proposal_function, log_density, iters=100
             if -p1 < 0.995 * entropy_print: 
                 entropy_print = -p1
                 acceptance = float(accept_cnt)/float(cnt)
-                s = ""
-                if pretty_state is not None:
-                    s = "\n" + pretty_state(state)
-                print(shutil.get_terminal_size().columns*'-')
-                print("\n Entropy : ", round(p1,4), 
-                    ", Iteration : ", it, 
-                    ", Acceptance Probability : ", 
-                    round(acceptance,4))
-                print(shutil.get_terminal_size().columns*'-')
-                print(s)
+                if verbose:
+                    s = ""
+                    if pretty_state is not None:
+                        s = "\n" + pretty_state(state)
+                    print(shutil.get_terminal_size().columns*'-')
+                    print("\n Entropy : ", round(p1,4), 
+                        ", Iteration : ", it, 
+                        ", Acceptance Probability : ", 
+                        round(acceptance,4))
+                    print(shutil.get_terminal_size().columns*'-')
+                    print(s)
                 
                 if acceptance < tolerance:
                     break
@@ -103,7 +112,8 @@ def metropolis_hastings(initial_state, proposal_function, log_density, iters=100
                 accept_cnt = 0
 
                 #sleep to see output
-                time.sleep(.1)
+                if verbose:
+                    time.sleep(.1)
     
     if error_function is None:
         errors = None
@@ -0,0 +1,233 @@
+import numpy as np
+from metropolis_hastings import *
+from deciphering_utils import *
+
+def build_registry(filenames, lexicon=False):
+    """
+    Loads several training corpora, keyed by file name
+
+    Arguments:
+    filenames: paths to the training corpora
+
+    lexicon: passed on to load_model
+
+    Returns:
+    registry: dict from file name to model, see load_model
+    """
+    registry = {}
+    for filename in filenames:
+        registry[filename] = load_model(filename, lexicon=lexicon)
+
+    return registry
+
+def compute_profile_log_probability(text, model):
+    """
+    Unigram log probability of a text under the model, taken at the frequency matched
+    permutation map. It only depends on the sorted character counts of the text, within
+    the letter and non-letter groups, so it does not depend on the cipher. It is also the
+    highest unigram log probability any map permuting within the groups can reach.
+
+    Arguments:
+    text: text, list of characters
+
+    model: model, see load_model
+
+    Returns:
+    p: the unigram log probability
+    """
+    char_to_ix = model["char_to_ix"]
+    fr = model["frequency_statistics"]
+    log_fr = np.log(fr / fr.sum())
+    counts = np.zeros(len(char_to_ix))
+    for c in text:
+        counts[char_to_ix[c]] += 1
+
+    p = 0.0
+    for in_group in (lambda c: c in LETTER_SET, lambda c: c not in LETTER_SET):
+        group = [i for c, i in char_to_ix.items() if in_group(c)]
+        p += float(np.sort(counts[group])[::-1] @ np.sort(log_fr[group])[::-1])
+
+    return p
+
+def frequency_matched_p_map(text, model):
+    """
+    Maps the k-th most frequent character of the text to the k-th most frequent character
+    of the model, within the letter and non-letter groups. Characters not in the text take
+    the remaining characters of their group in order.
+
+    Arguments:
+    text: text, list of characters
+
+    model: model, see load_model
+
+    Returns:
+    p_map: permutation map
+    """
+    char_to_ix = model["char_to_ix"]
+    fr = model["frequency_statistics"]
+    counts = {c : 0 for c in char_to_ix}
+    for c in text:
+        counts[c] += 1
+
+    p_map = {}
+    for in_group in (lambda c: c in LETTER_SET, lambda c: c not in LETTER_SET):
+        group = [c for c in char_to_ix if in_group(c)]
+        by_text = sorted(group, key=lambda c: counts[c], reverse=True)
+        by_model = sorted(group, key=lambda c: fr[char_to_ix[c]], reverse=True)
+        p_map.update(zip(by_text, by_model))
+
+    return p_map
+
+def mix_models(models, weights):
+    """
+    Weighted mixture of models over the same alphabet
+
+    Arguments:
+    models: list of models, see load_model
+
+    weights: mixture weight of each model, summing to one
+
+    Returns:
+    model: the mixture, it keeps the word lexicon of its heaviest component if that has one
+    """
+    tm = sum(w * m["transition_matrix"] for m, w in zip(models, weights))
+    fr = sum(w * m["frequency_statistics"] / m["frequency_statistics"].sum() for m, w in zip(models, weights))
+    fr *= sum(w * m["frequency_statistics"].sum() for m, w in zip(models, weights))
+    name = "mixture(" + ", ".join(f"{m['name']}:{w:.2f}" for m, w in zip(models, weights)) + ")"
+
+    heaviest = models[int(np.argmax(weights))]
+    model = {"name" : name, "char_to_ix" : heaviest["char_to_ix"], "ix_to_char" : heaviest["ix_to_char"],
+             "transition_matrix" : tm, "frequency_statistics" : fr,
+             "log_transition_matrix" : np.log(tm + 1e-8)}
+    if "word_log_probability" in heaviest:
+        model["word_log_probability"] = heaviest["word_log_probability"]
+        model["oov_log_probability"] = heaviest["oov_log_probability"]
+
+    return model
+
+def find_pilot_p_map(registry, text, pilot_iters=500, pilot_time=1.0, pilot_runs=1, pilot_passes=3):
+    """
+    Finds one permutation map to compare all models of a registry at. pilot_runs short
+    chains run under an even mixture of the models, from the frequency matched map, and
+    the best state they reach is polished by pilot_passes passes of refine_state.
+
+    Arguments:
+    registry: dict from name to model, see build_registry
+
+    text: ciphertext, list of characters in the alphabet
+
+    pilot_iters: number of iterations of each pilot chain
+
+    pilot_time: wall-clock budget in seconds of each pilot chain, and of the polish
+
+    pilot_runs: number of pilot chains
+
+    pilot_passes: maximum number of refine_state passes
+
+    Returns:
+    p_map: permutation map
+    """
+    models = list(registry.values())
+    mixture = mix_models(models, np.full(len(models), 1.0 / len(models)))
+    start = get_state(text, mixture["transition_matrix"], mixture["frequency_statistics"],
+                      mixture["char_to_ix"], mixture["log_transition_matrix"])
+    start["permutation_map"] = frequency_matched_p_map(text, mixture)
+
+    best, best_lp = start, compute_probability_of_state(start)
+    for _ in range(pilot_runs):
+        states, lps, _ = metropolis_hastings(start, proposal_function=propose_a_move,
+                                             log_density=compute_probability_of_state,
+                                             iters=pilot_iters, tolerance=0.0,
+                                             time_limit=pilot_time, verbose=False)
+        if lps and max(lps) > best_lp:
+            i = int(np.argmax(lps))
+            best, best_lp = states[i + 1], lps[i]
+
+    # the character score alone, an empty lexicon adds nothing
+    best = get_refinement_state(best, {}, 0.0, word_weight=0.0)
+    best, _ = refine_state(best, max_passes=pilot_passes, time_limit=pilot_time)
+
+    return best["permutation_map"]
+
+def select_model(registry, text, pilot_iters=500, pilot_time=1.0, pilot_runs=1, pilot_weight=2.0,
+                 mixture=False, temperature=0.1):
+    """
+    Picks the model of a registry that fits a ciphertext best, before the main run.
+    Every model is scored by compute_profile_log_probability plus pilot_weight times its
+    log probability at the pilot map of find_pilot_p_map. The pilot map is shared, so
+    the models are compared at the same decoding, as they would be at the true key.
+    The profile alone cannot tell texts apart whose sorted counts look alike.
+
+    Arguments:
+    registry: dict from name to model, see build_registry
+
+    text: ciphertext, list of characters in the alphabet
+
+    pilot_iters, pilot_time, pilot_runs: passed on to find_pilot_p_map
+
+    pilot_weight: weight of the pilot log probability in the score, 0 skips the pilot
+
+    mixture: if True, a mixture of the models is returned instead of the best one
+
+    temperature: the mixture weights are a softmax of the scores per character of text,
+                 divided by the temperature
+
+    Returns:
+    model: the selected model or mixture
+
+    report: list with the name, profile and pilot log probabilities, score per character
+            and weight of each model, best first
+    """
+    names = list(registry)
+    if len(names) == 1 and not mixture:
+        return registry[names[0]], [{"name" : names[0], "profile_log_probability" : None,
+                                     "pilot_log_probability" : None, "score" : None, "weight" : 1.0}]
+
+    p_map = None
+    if pilot_weight > 0 and text:
+        p_map = find_pilot_p_map(registry, text, pilot_iters=pilot_iters, pilot_time=pilot_time,
+                                 pilot_runs=pilot_runs)
+
+    profile_lps = []
+    pilot_lps = []
+    for name in names:
+        model = registry[name]
+        profile_lps.append(compute_profile_log_probability(text, model))
+        if p_map is None:
+            pilot_lps.append(None)
+            continue
+        state = get_state(text, model["transition_matrix"], model["frequency_statistics"],
+                          model["char_to_ix"], model["log_transition_matrix"])
+        state["permutation_map"] = p_map
+        pilot_lps.append(compute_probability_of_state(state))
+
+    scores = np.array([p + (0.0 if q is None else pilot_weight * q)
+                       for p, q in zip(profile_lps, pilot_lps)]) / max(len(text), 1)
+    weights = np.exp((scores - scores.max()) / temperature)
+    weights /= weights.sum()
+    order = np.argsort(-scores)
+
+    report = [{"name" : names[i], "profile_log_probability" : profile_lps[i],
+               "pilot_log_probability" : pilot_lps[i], "score" : float(scores[i]),
+               "weight" : float(weights[i])}
+              for i in order]
+
+    if mixture and len(names) > 1:
+        model = mix_models([registry[names[i]] for i in order], weights[order])
+    else:
+        model = registry[names[order[0]]]
+
+    return model, report
+
+def print_selection(report):
+    """
+    Prints the report of select_model
+    """
+    print("Model selection:")
+    for r in report:
+        if r["score"] is None:
+            print(f"  {r['name']}  |  weight {r['weight']:.2f}")
+            continue
+        pilot = "-" if r["pilot_log_probability"] is None else f"{r['pilot_log_probability']:.0f}"
+        print(f"  {r['name']}  |  profile logP {r['profile_log_probability']:.0f} | "
+              f"pilot logP {pilot} | score {r['score']:.3f} per char | weight {r['weight']:.2f}")
@@ -5,6 +5,7 @@ import shutil
 from optparse import OptionParser
 from metropolis_hastings import *
 from deciphering_utils import *
+from model_selection import *
 from utils import az_list
 
 def main(argv):
@@ -12,8 +13,8 @@ def main(argv):
     decodefile = None
     parser = OptionParser()
 
-    parser.add_option("-i", "--input", dest="inputfile", 
-                      help="input file to train the code on")
+    parser.add_option("-i", "--input", dest="inputfile", action="append",
+                      help="input file to train the code on, given several times the best fitting one is selected")
     parser.add_option("-d", "--decode", dest="decode", 
                       help="file that needs to be decoded")
     parser.add_option("-e", "--iters", dest="iterations", 
@@ -22,6 +23,22 @@ def main(argv):
                       help="percentage acceptance tolerance before stopping", default=0.02)
     parser.add_option("-p", "--print_every", dest="print_every", 
                       help="number of steps after which diagnostics should be printed", default=10000)
+    parser.add_option("-l", "--lexicon", dest="lexicon", action="store_true", default=False,
+                      help="refine the best guesses with a word lexicon of the training corpus")
+    parser.add_option("--word_weight", dest="word_weight", 
+                      help="weight of the word lexicon score during refinement", default=1.0)
+    parser.add_option("--refine_time", dest="refine_time", 
+                      help="time budget in seconds of the refinement, 0 for no limit", default=10)
+    parser.add_option("-m", "--mixture", dest="mixture", action="store_true", default=False,
+                      help="decode with a weighted mixture of the input files instead of the best one")
+    parser.add_option("--pilot_iters", dest="pilot_iters", 
+                      help="number of iterations of the pilot chains used to select a model", default=500)
+    parser.add_option("--pilot_runs", dest="pilot_runs", 
+                      help="number of pilot chains", default=1)
+    parser.add_option("--pilot_weight", dest="pilot_weight", 
+                      help="weight of the pilot in the model score, 0 skips it", default=2.0)
+    parser.add_option("--temperature", dest="temperature", 
+                      help="temperature of the mixture weights, in nats per character", default=0.1)
 
     (options, args) = parser.parse_args(argv)
 
@@ -32,9 +49,6 @@ def main(argv):
         print("Decoding file is not specified. Type -h for help.")
         sys.exit(2)
 
-    filename = options.inputfile
-    char_to_ix, ix_to_char, tr, fr = compute_statistics(filename)
-
     with open(options.decode, 'r', encoding='utf-8') as f:
         scrambled_text = f.read()
 
@@ -45,7 +59,18 @@ def main(argv):
     alphabet = az_list()
     scrambled_text = [c for c in scrambled_text if c in alphabet]
 
-    initial_state = get_state(scrambled_text, tr, fr, char_to_ix)
+    if len(options.inputfile) > 1 or options.mixture:
+        registry = build_registry(options.inputfile, lexicon=options.lexicon)
+        model, report = select_model(registry, scrambled_text, pilot_iters=int(options.pilot_iters),
+                                     pilot_runs=int(options.pilot_runs),
+                                     pilot_weight=float(options.pilot_weight), mixture=options.mixture,
+                                     temperature=float(options.temperature))
+        print_selection(report)
+    else:
+        model = load_model(options.inputfile[0], lexicon=options.lexicon)
+
+    initial_state = get_state(scrambled_text, model["transition_matrix"], model["frequency_statistics"],
+                              model["char_to_ix"], model["log_transition_matrix"])
     states = []
     entropies = []
 
@@ -70,8 +95,13 @@ def main(argv):
     results = list(zip(states, entropies))
     results.sort(key=lambda x: x[1]) 
 
+    if options.lexicon:
+        results = refine_candidates(results[::-1], model["word_log_probability"], model["oov_log_probability"],
+                                    word_weight=float(options.word_weight),
+                                    time_limit=float(options.refine_time) or None)[::-1]
+
     print("\nBest Guesses:\n")
-    for j in range(1, 4):
+    for j in range(1, min(3, len(results)) + 1):
         print(f"Guess {j}: \n")
         print(pretty_state(results[-j][0], full=True))
         print('*' * shutil.get_terminal_size().columns)
@@ -1,9 +1,12 @@
+import re
 import numpy as np
 import shutil
 import random
 from copy import deepcopy
 from copy import copy
 
+WORD_RE = re.compile(r"[A-Za-z]+")
+
 def az_list():
     """
     Returns all 82 characters in a fixed order.
@@ -140,6 +143,13 @@ def compute_statistics(filename):
     """
     with open(filename, 'r', encoding='utf-8') as f:
         data = f.read()
+
+    return compute_statistics_from_text(data)
+
+def compute_statistics_from_text(data):
+    """
+    Same as compute_statistics, from the text itself.
+    """
     data = " ".join(data.replace("\t", " ").replace("\n", " ").replace("\r", " ").split())
 
     alphabet = az_list()
@@ -161,4 +171,35 @@ def compute_statistics(filename):
     frequency_statistics[char_to_ix[data[-1]]] += 1
     transition_matrix /= transition_matrix.sum(axis=1, keepdims=True)
 
-    return char_to_ix, ix_to_char, transition_matrix, frequency_statistics
\ No newline at end of file
+    return char_to_ix, ix_to_char, transition_matrix, frequency_statistics
+
+def compute_word_statistics(filename):
+    """
+    Builds a word lexicon from a text file, words are runs of letters and keep their case.
+
+    Arguments:
+    filename: path to the input text file
+
+    Returns:
+    word_log_probability: add-one smoothed log probability of each word seen (dict)
+    oov_log_probability: log probability given to words not in the lexicon
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        data = f.read()
+
+    return compute_word_statistics_from_text(data)
+
+def compute_word_statistics_from_text(data):
+    """
+    Same as compute_word_statistics, from the text itself. Line breaks must be kept in
+    the text, they separate words too.
+    """
+    word_counts = {}
+    for w in WORD_RE.findall(data):
+        word_counts[w] = word_counts.get(w, 0) + 1
+
+    total = sum(word_counts.values()) + len(word_counts) + 1
+    word_log_probability = {w: np.log((c + 1) / total) for w, c in word_counts.items()}
+    oov_log_probability = np.log(1 / total)
+
+    return word_log_probability, oov_log_probability